@@ -2,19 +2,40 @@
 # coding: utf-8
 
 """Скрипт по перепаковке архивов из Диадока и СБИСа."""
+import argparse
 import calendar
+import concurrent.futures
+import contextlib
+import cProfile
+import csv
 import datetime
+import glob
+import hashlib
+import heapq
+import itertools
+import json
 import logging
+import multiprocessing
 import os
+import pstats
 import re
+import socket
+import sqlite3
+import sys
 import tempfile
+import threading
+import time
+import traceback
 import xml.etree.ElementTree as ElementTree
 import zipfile
+import zlib
 from os.path import basename, dirname, exists, join, relpath
-from shutil import copyfile, move, rmtree
+from shutil import copyfile, rmtree
+from typing import NamedTuple
 
 from dateutil.parser import parse
 from dotenv import load_dotenv
+import xlrd
 
 from tika import parser
 
@@ -63,25 +84,25 @@ def get_logger() -> logging.Logger:
     return _logger
 
 
-def get_document_no_date_xml(root: ElementTree.Element) -> tuple:
-    """Получение номера и даты документа xml."""
-    _tag = root.find('Документ/СвСчФакт')
-    if _tag is not None:
-        _number = _tag.get('НомерСчФ')
-        _date = parse(_tag.get('ДатаСчФ'))
-        return (_number, _date)
-
-    _tag = root.find('Документ/СвДокПРУ/ИдентДок')
-    if _tag is not None:
-        _number = _tag.get('НомДокПРУ')
-        _date = parse(_tag.get('ДатаДокПРУ'))
-        return (_number, _date)
+def get_document_no_date_xml(root: ElementTree.Element,
+                             rules: list = None) -> tuple:
+    """Получение номера и даты документа xml.
 
-    _tag = root.find('Документ')
-    if _tag is not None:
-        _number = _tag.get('Номер')
-        _date = parse(_tag.get('Дата'))
-        return (_number, _date)
+    В список rules, если он передан, добавляется сработавшее правило.
+    """
+    xml_tag_dict = {
+        'Документ/СвСчФакт': ('НомерСчФ', 'ДатаСчФ'),
+        'Документ/СвДокПРУ/ИдентДок': ('НомДокПРУ', 'ДатаДокПРУ'),
+        'Документ': ('Номер', 'Дата'),
+    }
+    for xml_path, (number_name, date_name) in xml_tag_dict.items():
+        _tag = root.find(xml_path)
+        if _tag is not None:
+            _number = _tag.get(number_name)
+            _date = parse(_tag.get(date_name))
+            if rules is not None:
+                rules.append(f'number:{xml_path}')
+            return (_number, _date)
 
     return NOT_RESOLVED, NOT_RESOLVED
 
@@ -115,8 +136,12 @@ def get_last_date_of_previous_month(dt: datetime.date):
     return datetime.date(dt_prev_month.year, dt_prev_month.month, last_day)
 
 
-def get_document_no_date_pdf(pdf_text: str, doc_type: str) -> tuple:
-    """Получение номера и даты документа pdf."""
+def get_document_no_date_pdf(pdf_text: str, doc_type: str,
+                             rules: list = None) -> tuple:
+    """Получение номера и даты документа pdf.
+
+    В список rules, если он передан, добавляется сработавшее правило.
+    """
     if doc_type == 'АПП':
         # маска номера и даты документа для АПП
         doc_no_mask = (
@@ -152,9 +177,15 @@ def get_document_no_date_pdf(pdf_text: str, doc_type: str) -> tuple:
         )
 
     doc_number = NOT_RESOLVED
-    for mask in doc_no_mask:
+    for mask_no, mask in enumerate(doc_no_mask):
         res0 = re.search(mask, pdf_text)
         if res0 is not None:
+            if rules is not None:
+                rules.append(
+                    'number:{}#{}'.format(
+                        'АПП' if doc_type == 'АПП' else 'АСВ', mask_no
+                    )
+                )
             doc_number = res0[1]
             # Так как номер документа будет присутствовать в имени архива,
             # то нужно убрать из номер документа символы, которые недопустимы
@@ -172,8 +203,11 @@ def get_document_no_date_pdf(pdf_text: str, doc_type: str) -> tuple:
     return NOT_RESOLVED, NOT_RESOLVED
 
 
-def get_market_xml(root: ElementTree.Element) -> str:
-    """Получение типа рынка."""
+def get_market_xml(root: ElementTree.Element, rules: list = None) -> str:
+    """Получение типа рынка.
+
+    В список rules, если он передан, добавляется сработавшее правило.
+    """
     _markets = {
         'RDN': 'РДД',
         'DPMC': 'ДПМ ТЭС',
@@ -216,38 +250,50 @@ def get_market_xml(root: ElementTree.Element) -> str:
                 _osn_num = _tag.get(osn_name)
                 if _osn_num is not None:
                     _osn_num = _osn_num.upper()
-                    for mask in market_mask:
+                    for mask_no, mask in enumerate(market_mask):
                         res = re.search(mask, _osn_num)
                         if res is not None:
                             eng_market = res[1]
                             if eng_market in _markets:
+                                if rules is not None:
+                                    rules.append(
+                                        f'market:{xml_path}@{osn_name}'
+                                        f'#{mask_no}'
+                                    )
                                 return _markets[eng_market]
 
     _tag = root.find('Документ/СвДокПРУ/СодФХЖ1/ЗагСодОпер')
     if _tag is not None:
         _osn_num = _tag.get(osn_name)
-        for mask in market_mask:
+        for mask_no, mask in enumerate(market_mask):
             res = re.search(mask, _osn_num)
             if res is not None:
                 eng_market = res[1]
                 if eng_market in _markets:
+                    if rules is not None:
+                        rules.append(f'market:ЗагСодОпер#{mask_no}')
                     return _markets[eng_market]
 
     _tags = root.findall('Документ/СвСчФакт/ИнфПолФХЖ1/ТекстИнф')
     for _tag in _tags:
         _osn_num = _tag.get('Значен').upper()
-        for mask in market_mask:
+        for mask_no, mask in enumerate(market_mask):
             res = re.search(mask, _osn_num)
             if res is not None:
                 eng_market = res[1]
                 if eng_market in _markets:
+                    if rules is not None:
+                        rules.append(f'market:ТекстИнф#{mask_no}')
                     return _markets[eng_market]
 
     return NOT_RESOLVED
 
 
-def get_market_pdf(pdf_text: str, doc_type: str) -> str:
-    """Получение типа рынка из файла pdf."""
+def get_market_pdf(pdf_text: str, doc_type: str, rules: list = None) -> str:
+    """Получение типа рынка из файла pdf.
+
+    В список rules, если он передан, добавляется сработавшее правило.
+    """
     _markets = {
         'RDN': 'РДД',
         'DPMC': 'ДПМ ТЭС',
@@ -293,16 +339,248 @@ def get_market_pdf(pdf_text: str, doc_type: str) -> str:
             r'№\s*?(KOMMOD)-', # noqa
         )
 
-    for mask in market_mask:
+    for mask_no, mask in enumerate(market_mask):
         res0 = re.search(mask, pdf_text, re.S)
         if res0 is not None:
             eng_market = res0[1]
             if eng_market in _markets:
+                if rules is not None:
+                    rules.append(
+                        'market:{}#{}'.format(
+                            'АПП' if doc_type == 'АПП' else 'АСВ', mask_no
+                        )
+                    )
                 return _markets[eng_market]
     return NOT_RESOLVED
 
 
-def pack_and_move_diadoc(_doc_path: str, _dest_path: str):
+def get_file_hash(_file: str) -> str:
+    """Получение хэша sha256 файла."""
+    _hash = hashlib.sha256()
+    with open(_file, 'rb') as file_0:
+        for chunk in iter(lambda: file_0.read(1024 * 1024), b''):
+            _hash.update(chunk)
+    return _hash.hexdigest()
+
+
+def get_zip_fingerprint(_zip_path: str) -> list:
+    """Состав архива без учёта времени упаковки: имя, CRC и размер."""
+    with zipfile.ZipFile(_zip_path, 'r') as zip_file:
+        return sorted(
+            (info.filename, info.CRC, info.file_size)
+            for info in zip_file.infolist()
+        )
+
+
+def parse_package_path(_package_path: str) -> dict:
+    """Разбор пути пакета в архиве документов.
+
+    Путь имеет вид MAIN_DOC_DIR/<ГГГГ-ММ>/Покупка/<рынок>/<поставщик>/
+    <тип> № <номер> от <дата>.zip
+    """
+    parts = relpath(_package_path, MAIN_DOC_DIR).replace('\\', '/').split('/')
+    if len(parts) != 5 or parts[1] != 'Покупка':
+        return {}
+    res = re.match(r'^(.+?) № (.+) от (\d{2}\.\d{2}\.\d{4})\.zip$', parts[4])
+    if res is None:
+        return {}
+    return {
+        'path': _package_path,
+        'market': parts[2],
+        'supplier': parts[3],
+        'doc_type': res[1],
+        'number': res[2],
+        'date': datetime.datetime.strptime(res[3], '%d.%m.%Y').strftime(
+            '%Y-%m-%d'
+        ),
+    }
+
+
+def open_index() -> sqlite3.Connection:
+    """Открытие индекса архива документов."""
+    conn = sqlite3.connect(INDEX_DB, timeout=60)
+    conn.row_factory = sqlite3.Row
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS documents ('
+        ' path TEXT PRIMARY KEY,'
+        ' supplier TEXT NOT NULL,'
+        ' market TEXT NOT NULL,'
+        ' doc_type TEXT NOT NULL,'
+        ' number TEXT NOT NULL,'
+        ' date TEXT NOT NULL,'
+        ' source TEXT NOT NULL,'
+        ' sha256 TEXT NOT NULL,'
+        ' size INTEGER NOT NULL,'
+        ' indexed_at TEXT NOT NULL)'
+    )
+    for column in ('supplier', 'number', 'date'):
+        conn.execute(
+            f'CREATE INDEX IF NOT EXISTS documents_{column}'
+            f' ON documents ({column})'
+        )
+    return conn
+
+
+def index_package(conn: sqlite3.Connection, _package_path: str,
+                  _source: str, _sha256: str, _size: int) -> None:
+    """Запись пакета в индекс архива документов."""
+    record = parse_package_path(_package_path)
+    if not record:
+        return
+    record.update({
+        'source': _source,
+        'sha256': _sha256,
+        'size': _size,
+        'indexed_at': datetime.datetime.now().isoformat(timespec='seconds'),
+    })
+    conn.execute(
+        'INSERT INTO documents (path, supplier, market, doc_type, number,'
+        ' date, source, sha256, size, indexed_at)'
+        ' VALUES (:path, :supplier, :market, :doc_type, :number, :date,'
+        ' :source, :sha256, :size, :indexed_at)'
+        ' ON CONFLICT (path) DO UPDATE SET'
+        ' source = CASE WHEN excluded.source = \'\''
+        ' THEN documents.source ELSE excluded.source END,'
+        ' sha256 = excluded.sha256, size = excluded.size,'
+        ' indexed_at = excluded.indexed_at',
+        record,
+    )
+
+
+def is_same_package(_zip_path: str, _other_zip_path: str) -> bool:
+    """Проверка, что два пакета содержат одни и те же файлы."""
+    try:
+        return (get_zip_fingerprint(_zip_path) ==
+                get_zip_fingerprint(_other_zip_path))
+    except (OSError, zipfile.BadZipFile):
+        # пакет ещё копируется другим потоком или узлом
+        return False
+
+
+def move_to_volume(_src_path: str, _dest_path: str) -> None:
+    """Перемещение файла: переименование на том же томе, иначе копирование."""
+    try:
+        os.replace(_src_path, _dest_path)
+        return
+    except OSError:
+        pass
+    try:
+        copyfile(_src_path, _dest_path)
+    except BaseException:
+        if exists(_dest_path):
+            os.remove(_dest_path)
+        raise
+    os.remove(_src_path)
+
+
+def claim_name(_tmp_path: str, _dest_path: str) -> None:
+    """Атомарное переименование без замены существующего файла.
+
+    Если имя уже занято, вызывается FileExistsError.
+    """
+    if os.name == 'nt':
+        # на Windows os.rename не заменяет существующий файл
+        os.rename(_tmp_path, _dest_path)
+    else:
+        os.link(_tmp_path, _dest_path)
+        os.remove(_tmp_path)
+
+
+def publish_package(_zip_path: str, _dest_path: str, _source: str) -> bool:
+    """Перемещение пакета в архив документов с проверкой коллизий имён.
+
+    Пакет сначала целиком переносится под временным именем в папку
+    назначения, затем атомарно получает итоговое имя без замены
+    существующего файла. Поэтому под итоговым именем никогда не лежит
+    недописанный пакет, а два пакета с одинаковым именем не затрут друг
+    друга даже при обработке в несколько потоков или с нескольких машин.
+    Если по пути назначения уже лежит пакет с другим содержимым, новый
+    пакет не публикуется.
+    """
+    if not exists(dirname(_dest_path)):
+        os.makedirs(dirname(_dest_path), exist_ok=True)
+    _sha256 = get_file_hash(_zip_path)
+    _size = os.path.getsize(_zip_path)
+    _tmp_path = '{}.{}.{}.{}.tmp'.format(
+        _dest_path, HOST_ID, os.getpid(), threading.get_ident()
+    )
+    move_to_volume(_zip_path, _tmp_path)
+    try:
+        claim_name(_tmp_path, _dest_path)
+    except FileExistsError:
+        is_same = is_same_package(_dest_path, _tmp_path)
+        os.remove(_tmp_path)
+        if not is_same:
+            error_str = (
+                'Коллизия имени пакета {}: уже существует пакет с другим '
+                'содержимым. Источник {}.'
+            ).format(_dest_path, _source)
+            print(error_str)
+            logger.error(error_str)
+            return False
+        # такой же пакет уже опубликован ранее
+        _sha256 = get_file_hash(_dest_path)
+        _size = os.path.getsize(_dest_path)
+    except BaseException:
+        if exists(_tmp_path):
+            os.remove(_tmp_path)
+        raise
+
+    try:
+        with contextlib.closing(open_index()) as conn, conn:
+            index_package(conn, _dest_path, _source, _sha256, _size)
+    except sqlite3.Error as exc:
+        # пакет уже опубликован, в индекс его добавит "index rebuild"
+        logger.error('Пакет %s не записан в индекс: %s', _dest_path, exc)
+    return True
+
+
+def rebuild_index() -> int:
+    """Индексация пакетов, уже лежащих в архиве документов."""
+    mask = join(glob.escape(MAIN_DOC_DIR), '*', 'Покупка', '*', '*', '*.zip')
+    count = 0
+    with contextlib.closing(open_index()) as conn, conn:
+        for _package_path in glob.iglob(mask):
+            index_package(
+                conn,
+                _package_path,
+                '',
+                get_file_hash(_package_path),
+                os.path.getsize(_package_path),
+            )
+            count += 1
+    return count
+
+
+def query_index(**filters) -> list:
+    """Поиск пакетов в индексе архива документов.
+
+    Фильтры supplier, market, doc_type, number ищут вхождение подстроки,
+    date_from и date_to ограничивают дату документа (ГГГГ-ММ-ДД).
+    """
+    conditions = []
+    params = {}
+    for column in ('supplier', 'market', 'doc_type', 'number'):
+        if filters.get(column):
+            conditions.append(f'{column} LIKE :{column}')
+            params[column] = f'%{filters[column]}%'
+    if filters.get('date_from'):
+        conditions.append('date >= :date_from')
+        params['date_from'] = filters['date_from']
+    if filters.get('date_to'):
+        conditions.append('date <= :date_to')
+        params['date_to'] = filters['date_to']
+
+    sql = 'SELECT * FROM documents'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY date, supplier, doc_type, number'
+    with contextlib.closing(open_index()) as conn:
+        return [dict(row) for row in conn.execute(sql, params)]
+
+
+def pack_and_move_diadoc(_doc_path: str, _dest_path: str,
+                         _source: str = '') -> bool:
     """Упаковка файлов в архив и перемещение в целевую папку."""
     _zip_file = zipfile.ZipFile(_doc_path + '.zip', 'w')
     for folder, _, files in os.walk(_doc_path):
@@ -313,9 +591,7 @@ def pack_and_move_diadoc(_doc_path: str, _dest_path: str):
                 compress_type=zipfile.ZIP_DEFLATED,
             )
     _zip_file.close()
-    if not exists(dirname(_dest_path)):
-        os.makedirs(dirname(_dest_path))
-    move(_doc_path + '.zip', _dest_path)
+    return publish_package(_doc_path + '.zip', _dest_path, _source)
 
 
 def get_property_from_xml(_file: str, _tag_path: str, _tag_prop: str) -> str:
@@ -330,8 +606,87 @@ def get_property_from_xml(_file: str, _tag_path: str, _tag_prop: str) -> str:
     return ''
 
 
-def pack_and_move_sbis(_doc_file: str, _dest_path: str):
-    """Упаковка файлов в архив и перемещение в целевую папку."""
+def get_member_payload(_file: str, member_cache: dict) -> tuple:
+    """Сжатый файл для архива из кэша: CRC, размер, сжатые данные.
+
+    Файл сжимается по частям и кэшируется, пока кэш не превышает
+    MEMBER_CACHE_SIZE байт; если места не хватает, возвращается None.
+    """
+    payload = member_cache.get(_file)
+    if payload is not None:
+        return payload
+    cache_size = sum(len(cached[2]) for cached in member_cache.values())
+    if cache_size + os.path.getsize(_file) > MEMBER_CACHE_SIZE:
+        return None
+
+    # те же параметры deflate, что использует zipfile
+    compressor = zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15
+    )
+    crc = 0
+    file_size = 0
+    compressed = []
+    with open(_file, 'rb') as file_0:
+        chunk = file_0.read(2 ** 20)
+        while chunk:
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            compressed.append(compressor.compress(chunk))
+            chunk = file_0.read(2 ** 20)
+    compressed.append(compressor.flush())
+    payload = (crc, file_size, b''.join(compressed))
+    member_cache[_file] = payload
+    return payload
+
+
+def write_compressed_member(_zip_file: zipfile.ZipFile,
+                            zinfo: zipfile.ZipInfo, compressed: bytes) -> None:
+    """Запись в архив уже сжатых (deflate) данных.
+
+    У ZipFile нет открытого способа записать готовые сжатые данные,
+    поэтому запись идёт через его внутреннее состояние (fp, start_dir,
+    filelist, NameToInfo). Проверено на Python 3.8 - 3.13
+    (tests/test_zip_members.py).
+    """
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.compress_size = len(compressed)
+    zinfo.header_offset = _zip_file.fp.tell()
+    _zip_file.fp.write(zinfo.FileHeader())
+    _zip_file.fp.write(compressed)
+    _zip_file.filelist.append(zinfo)
+    _zip_file.NameToInfo[zinfo.filename] = zinfo
+    _zip_file.start_dir = _zip_file.fp.tell()
+    _zip_file._didModify = True  # pylint: disable=protected-access
+
+
+def write_shared_member(_zip_file: zipfile.ZipFile, _file: str,
+                        _arc_name: str, member_cache: dict) -> None:
+    """Запись в архив файла, общего для нескольких документов папки.
+
+    Файл сжимается один раз на папку СБИСа; если он не помещается в кэш,
+    сжимается при каждой записи, как обычный файл.
+    """
+    payload = get_member_payload(_file, member_cache)
+    if payload is None:
+        _zip_file.write(
+            _file, _arc_name, compress_type=zipfile.ZIP_DEFLATED
+        )
+        return
+    zinfo = zipfile.ZipInfo.from_file(_file, _arc_name)
+    zinfo.CRC, zinfo.file_size, compressed = payload
+    write_compressed_member(_zip_file, zinfo, compressed)
+
+
+def pack_and_move_sbis(_doc_file: str, _dest_path: str,
+                       _source: str = '', member_cache: dict = None) -> bool:
+    """Упаковка файлов в архив и перемещение в целевую папку.
+
+    member_cache - общий для папки СБИСа кэш сжатых файлов, чтобы файлы,
+    входящие в архивы всех документов папки (справки о прохождении,
+    DP_PDPOL, DP_UVPRIEM, ON_NSCHFDOPPOK, DP_REZRUZAK), сжимались один раз.
+    """
+    if member_cache is None:
+        member_cache = {}
     _doc_path = dirname(_doc_file)
     _short_file_name = basename(_doc_file)
 
@@ -361,24 +716,42 @@ def pack_and_move_sbis(_doc_file: str, _dest_path: str):
             'Функция'
         ).upper()
 
-    _zip_file = zipfile.ZipFile(join(_doc_path, 'sbis') + '.zip', 'w')
+    # пакет собирается в локальном файле своего процесса и потока: при
+    # перехвате аренды прежний и новый владелец не пишут в один файл
+    # в папке СБИСа на общем диске (publish_package файл забирает)
+    _zip_path = join(
+        tempfile.gettempdir(),
+        f'sbis.{os.getpid()}.{threading.get_ident()}.zip',
+    )
+    _zip_file = zipfile.ZipFile(_zip_path, 'w')
     for folder, _, files in os.walk(_doc_path):
         for file in files:
             if (
                 os.path.splitext(_short_file_name)[0].upper() in file.upper()
                     or 'СПРАВКА О ПРОХОЖДЕНИИ' in file.upper()
             ):
-                if r'/PDF/' in join(folder, file):
-                    os.rename(
+                _arc_file = file
+                if (r'/PDF/' in join(folder, file)
+                        and not file.startswith('ПЕЧАТНАЯ ФОРМА')):
+                    # печатная форма переименовывается только в архиве,
+                    # файл на диске остаётся прежним для других документов
+                    _arc_file = 'ПЕЧАТНАЯ ФОРМА' + file
+                if 'СПРАВКА О ПРОХОЖДЕНИИ' in file.upper():
+                    write_shared_member(
+                        _zip_file,
                         join(folder, file),
-                        join(folder, 'ПЕЧАТНАЯ ФОРМА' + file)
+                        relpath(join(folder, _arc_file), _doc_path),
+                        member_cache,
                     )
-                    file = 'ПЕЧАТНАЯ ФОРМА' + file
-                _zip_file.write(
-                    join(folder, file),
-                    relpath(join(folder, file), _doc_path),
-                    compress_type=zipfile.ZIP_DEFLATED,
-                )
+                else:
+                    _zip_file.write(
+                        join(folder, file),
+                        relpath(join(folder, _arc_file), _doc_path),
+                        compress_type=zipfile.ZIP_DEFLATED,
+                    )
+                if _arc_file != file:
+                    # печатная форма под правила ниже не подходит
+                    continue
 
             if (file.upper().startswith('DP_IZVPOL') and
                     file.upper().endswith('.XML') and
@@ -431,33 +804,34 @@ def pack_and_move_sbis(_doc_file: str, _dest_path: str):
 
             if (file.upper().startswith('DP_PDPOL')
                     and _doc_type.upper() == 'СЧФ'):
-                _zip_file.write(
+                write_shared_member(
+                    _zip_file,
                     join(folder, file),
                     relpath(join(folder, file), _doc_path),
-                    compress_type=zipfile.ZIP_DEFLATED,
+                    member_cache,
                 )
 
             if ((file.upper().startswith('ON_NSCHFDOPPOK')
                     or file.upper().startswith('DP_REZRUZAK')) and
                     _doc_type.upper() == 'ДОП'):
-                _zip_file.write(
+                write_shared_member(
+                    _zip_file,
                     join(folder, file),
                     relpath(join(folder, file), _doc_path),
-                    compress_type=zipfile.ZIP_DEFLATED,
+                    member_cache,
                 )
 
             if (file.upper().startswith('DP_UVPRIEM')
                     and _doc_type.upper() == 'СЧФ'):
-                _zip_file.write(
+                write_shared_member(
+                    _zip_file,
                     join(folder, file),
                     relpath(join(folder, file), _doc_path),
-                    compress_type=zipfile.ZIP_DEFLATED,
+                    member_cache,
                 )
 
     _zip_file.close()
-    if not exists(dirname(_dest_path)):
-        os.makedirs(dirname(_dest_path))
-    move(join(_doc_path, 'sbis') + '.zip', _dest_path)
+    return publish_package(_zip_path, _dest_path, _source)
 
 
 def get_document_type(root: ElementTree.Element, filename='') -> str:
@@ -485,22 +859,40 @@ def get_document_type(root: ElementTree.Element, filename='') -> str:
     return NOT_RESOLVED
 
 
-def process_xml(_supplier_path: str, xml_file: str) -> str:
-    """Процедура обработки XML."""
+def classify_xml(xml_file: str) -> dict:
+    """Определение типа, рынка, номера и даты документа XML."""
     root = ElementTree.parse(xml_file).getroot()
-    _short_name = basename(xml_file)
-
-    is_success = False
+    rules = []
 
     # определение типа документа (АСВ, АПП, СЧФ)
     doc_type = get_document_type(root, basename(xml_file))
 
     # определение рынка
-    market_type = get_market_xml(root)
+    market_type = get_market_xml(root, rules)
 
-    doc_number, doc_date = get_document_no_date_xml(root)
+    doc_number, doc_date = get_document_no_date_xml(root, rules)
     doc_number = doc_number.replace('\\', '_')
     doc_number = doc_number.replace('/', '_')
+    return {
+        'doc_type': doc_type,
+        'market_type': market_type,
+        'doc_number': doc_number,
+        'doc_date': doc_date,
+        'rule': '; '.join(rules),
+    }
+
+
+def process_xml(_supplier_path: str, xml_file: str) -> str:
+    """Процедура обработки XML."""
+    _short_name = basename(xml_file)
+
+    is_success = False
+
+    result = classify_xml(xml_file)
+    doc_type = result['doc_type']
+    market_type = result['market_type']
+    doc_number = result['doc_number']
+    doc_date = result['doc_date']
     _date_str = doc_date.strftime(r'%d.%m.%Y')
 
     message_dict = {
@@ -543,12 +935,61 @@ def process_xml(_supplier_path: str, xml_file: str) -> str:
     return ''
 
 
-def process_pdf(_supplier_path: str, pdf_file: str) -> str:
-    """Процедура обработки PDF."""
-    is_success = False
+def get_xls_text(xls_file: str) -> str:
+    """Получение текста ячеек книги XLS без обращения к Tika.
+
+    Как и у Tika, листы идут подряд, ячейки строки разделены табуляцией,
+    каждая строка, включая последнюю, заканчивается переводом строки
+    (маски АПП, оканчивающиеся на \\s, рассчитаны на него).
+    В отличие от Tika, которая выводит даты по формату ячейки, даты всегда
+    выводятся как %d.%m.%Y.
+    """
+    book = xlrd.open_workbook(xls_file, on_demand=True)
+    lines = []
+    try:
+        for sheet_no in range(book.nsheets):
+            sheet = book.sheet_by_index(sheet_no)
+            lines.append(sheet.name)
+            for row_no in range(sheet.nrows):
+                cells = []
+                for cell in sheet.row(row_no):
+                    if cell.ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK):
+                        continue
+                    if cell.ctype == xlrd.XL_CELL_DATE:
+                        cells.append(xlrd.xldate_as_datetime(
+                            cell.value, book.datemode
+                        ).strftime(r'%d.%m.%Y'))
+                    elif (cell.ctype == xlrd.XL_CELL_NUMBER
+                          and cell.value == int(cell.value)):
+                        cells.append(str(int(cell.value)))
+                    else:
+                        cells.append(str(cell.value))
+                if cells:
+                    lines.append('\t'.join(cells))
+            book.unload_sheet(sheet_no)
+    finally:
+        book.release_resources()
+    return ''.join(f'{line}\n' for line in lines)
+
+
+def get_document_text(doc_file: str) -> str:
+    """Получение текста документа pdf/xls."""
+    if doc_file.upper().endswith('.XLS'):
+        try:
+            return get_xls_text(doc_file)
+        except (xlrd.XLRDError, xlrd.compdoc.CompDocError):
+            # под расширением xls может оказаться другой формат,
+            # его разбирает Tika
+            pass
+    return parser.from_file(doc_file)['content']
+
+
+def classify_pdf(pdf_file: str) -> dict:
+    """Определение типа, рынка, номера и даты документа PDF."""
     _short_name = basename(pdf_file)
+    rules = []
 
-    page_text = parser.from_file(pdf_file)['content'].upper()
+    page_text = get_document_text(pdf_file).upper()
 
     if ('СВЕРКИ' in _short_name.upper() or
             'ВЗАИМОРАСЧЕТОВ' in _short_name.upper() or
@@ -562,17 +1003,37 @@ def process_pdf(_supplier_path: str, pdf_file: str) -> str:
             doc_type = 'АСВ'
     else:
         doc_type = 'АПП'
-    doc_number = NOT_RESOLVED
+    doc_number, doc_date = get_document_no_date_pdf(
+        page_text, doc_type, rules
+    )
+
+    # определение рынка
+    market_type = get_market_pdf(page_text, doc_type, rules)
+    return {
+        'doc_type': doc_type,
+        'market_type': market_type,
+        'doc_number': doc_number,
+        'doc_date': doc_date,
+        'rule': '; '.join(rules),
+    }
+
+
+def process_pdf(_supplier_path: str, pdf_file: str) -> str:
+    """Процедура обработки PDF."""
+    is_success = False
+    _short_name = basename(pdf_file)
+
+    result = classify_pdf(pdf_file)
+    doc_type = result['doc_type']
+    market_type = result['market_type']
+    doc_number = result['doc_number']
+    doc_date = result['doc_date']
     _date_str = NOT_RESOLVED
     _date_str_1 = NOT_RESOLVED
-    doc_number, doc_date = get_document_no_date_pdf(page_text, doc_type)
     if doc_date != NOT_RESOLVED:
         _date_str = doc_date.strftime(r'%d.%m.%Y')
         _date_str_1 = doc_date.strftime(r'%Y-%m')
 
-    # определение рынка
-    market_type = get_market_pdf(page_text, doc_type)
-
     message_dict = {
             '_short_name': _short_name,
             '_supplier_path': _supplier_path,
@@ -613,6 +1074,270 @@ def process_pdf(_supplier_path: str, pdf_file: str) -> str:
     return ''
 
 
+# Обработчики документов по типу (xml/pdf)
+DOCUMENT_HANDLERS = {
+    'XML': process_xml,
+    'PDF': process_pdf,
+}
+# Разбор документов по типу без упаковки и перемещения
+DOCUMENT_CLASSIFIERS = {
+    'XML': classify_xml,
+    'PDF': classify_pdf,
+}
+# Причины неудачи вызова в процессе-обработчике по статусу
+WORKER_ERRORS = {
+    'TIMEOUT': 'timeout',
+    'CRASH': 'сбой обработчика',
+    'ERROR': 'ошибка обработки',
+}
+# Процессы-обработчики запускаются из рабочих потоков; при fork дочерний
+# процесс унаследовал бы блокировки, захваченные другими потоками
+# (логгер, ввод-вывод), поэтому процессы запускаются заново через spawn
+WORKER_CONTEXT = multiprocessing.get_context('spawn')
+
+
+def document_worker_loop(conn) -> None:
+    """Цикл процесса-обработчика документов.
+
+    Задача - функция уровня модуля и кортеж её аргументов.
+    """
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        func, args = task
+        try:
+            conn.send(('OK', func(*args)))
+        except Exception:  # pylint: disable=broad-except
+            conn.send(('ERROR', traceback.format_exc()))
+
+
+class BufferProfiler:
+    """Профилирование обработки буфера.
+
+    Для каждого профиля (общего или по поставщику) сохраняются статистика
+    cProfile (.prof), свёрнутые стеки для flamegraph (.collapsed.txt)
+    и сводка по этапам обработки. Отдельно ведётся список самых медленных
+    документов.
+    """
+
+    # этапы обработки и функции (модуль, имя), по которым считается их время
+    STAGES = {
+        'Распаковка': (('repack_orem', 'unpack_zip'),),
+        'Разбор XML': (('repack_orem', 'process_xml'),),
+        'Разбор PDF': (('repack_orem', 'process_pdf'),),
+        'Извлечение текста (Tika)': (('tika', 'from_file'),),
+        'Чтение XLS': (('repack_orem', 'get_xls_text'),),
+        'Упаковка': (
+            ('repack_orem', 'pack_and_move_diadoc'),
+            ('repack_orem', 'pack_and_move_sbis'),
+        ),
+    }
+
+    def __init__(self, mode: str, out_dir: str, top: int = 20,
+                 interval: float = 0.005):
+        self.per_supplier = mode == 'supplier'
+        self.out_dir = join(
+            out_dir, datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S')
+        )
+        self.top = top
+        self.interval = interval
+        self.documents = []
+        os.makedirs(self.out_dir, exist_ok=True)
+
+    def _sample(self, thread_id: int, stacks: dict,
+                stop_event: threading.Event) -> None:
+        """Сбор свёрнутых стеков профилируемого потока."""
+        while not stop_event.wait(self.interval):
+            frame = sys._current_frames().get(  # pylint: disable=W0212
+                thread_id
+            )
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(
+                    f'{code.co_name} '
+                    f'({basename(code.co_filename)}:{code.co_firstlineno})'
+                )
+                frame = frame.f_back
+            if names:
+                stack = ';'.join(reversed(names))
+                stacks[stack] = stacks.get(stack, 0) + 1
+
+    @contextlib.contextmanager
+    def profile(self, name: str):
+        """Профилирование блока кода с сохранением под именем name."""
+        profiler = cProfile.Profile()
+        stacks = {}
+        stop_event = threading.Event()
+        sampler = threading.Thread(
+            target=self._sample,
+            args=(threading.get_ident(), stacks, stop_event),
+            daemon=True,
+        )
+        sampler.start()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            stop_event.set()
+            sampler.join()
+            self._save(name, profiler, stacks)
+
+    def _save(self, name: str, profiler: cProfile.Profile,
+              stacks: dict) -> None:
+        """Сохранение результатов профилирования."""
+        profiler.dump_stats(join(self.out_dir, f'{name}.prof'))
+
+        with open(join(self.out_dir, f'{name}.collapsed.txt'), 'w',
+                  encoding='utf-8') as out_file:
+            for stack, count in sorted(stacks.items()):
+                out_file.write(f'{stack} {count}\n')
+
+        with open(join(self.out_dir, f'{name}.stages.txt'), 'w',
+                  encoding='utf-8') as out_file:
+            stats = pstats.Stats(profiler, stream=out_file)
+            for stage, functions in self.STAGES.items():
+                cum_time = sum(
+                    value[3] for key, value in stats.stats.items()
+                    if any(
+                        module in key[0] and func_name == key[2]
+                        for module, func_name in functions
+                    )
+                )
+                out_file.write(f'{stage}: {cum_time:.3f} с\n')
+            out_file.write('\n')
+            stats.sort_stats('cumulative').print_stats(self.top)
+        logger.info('Профиль %s сохранён в %s', name, self.out_dir)
+
+    def add_document(self, duration: float, supplier_path: str,
+                     doc_file: str) -> None:
+        """Учёт времени разбора документа."""
+        self.documents.append((duration, supplier_path, basename(doc_file)))
+
+    def save_documents(self) -> None:
+        """Сохранение списка самых медленных документов."""
+        slowest = sorted(self.documents, reverse=True)[:self.top]
+        with open(join(self.out_dir, 'slowest_documents.txt'), 'w',
+                  encoding='utf-8') as out_file:
+            for duration, supplier_path, doc_file in slowest:
+                out_file.write(
+                    f'{duration:.3f}\t{supplier_path}\t{doc_file}\n'
+                )
+        print('Самые медленные документы:')
+        for duration, supplier_path, doc_file in slowest:
+            print(f'{duration:8.3f} с  {supplier_path}  {doc_file}')
+
+
+class DocumentWorker:
+    """Отдельный процесс для разбора документов с ограничением по времени.
+
+    Если документ не разобран за timeout секунд, процесс завершается
+    принудительно и перезапускается на следующем документе.
+    При timeout <= 0 документы разбираются в текущем процессе.
+    """
+
+    def __init__(self, timeout: float, profiler: BufferProfiler = None):
+        self.timeout = timeout
+        self.profiler = profiler
+        self._process = None
+        self._conn = None
+
+    def _start(self) -> None:
+        """Запуск процесса-обработчика."""
+        self._conn, child_conn = WORKER_CONTEXT.Pipe()
+        self._process = WORKER_CONTEXT.Process(
+            target=document_worker_loop,
+            args=(child_conn,),
+            daemon=True,
+        )
+        self._process.start()
+        child_conn.close()
+
+    def _kill(self) -> None:
+        """Принудительное завершение процесса-обработчика."""
+        self._process.kill()
+        self._process.join()
+        self._conn.close()
+        self._process = None
+        self._conn = None
+
+    def stop(self) -> None:
+        """Завершение процесса-обработчика."""
+        if self._process is None:
+            return
+        try:
+            self._conn.send(None)
+        except OSError:
+            pass
+        self._process.join(5)
+        self._kill()
+
+    def process(self, kind: str, supplier_path: str, doc_file: str) -> str:
+        """Разбор документа, возвращает путь назначения или ''."""
+        if self.profiler is None:
+            return self._process_document(kind, supplier_path, doc_file)
+
+        start_time = time.perf_counter()
+        try:
+            return self._process_document(kind, supplier_path, doc_file)
+        finally:
+            self.profiler.add_document(
+                time.perf_counter() - start_time, supplier_path, doc_file
+            )
+
+    def call(self, func, *args) -> tuple:
+        """Вызов функции в процессе-обработчике: (статус, результат).
+
+        Статус OK, ERROR (результат - трассировка исключения), TIMEOUT
+        или CRASH.
+        """
+        if self.timeout <= 0:
+            try:
+                return 'OK', func(*args)
+            except Exception:  # pylint: disable=broad-except
+                return 'ERROR', traceback.format_exc()
+        return self._run((func, args))
+
+    def _run(self, task: tuple) -> tuple:
+        """Выполнение задачи в процессе-обработчике: (статус, результат)."""
+        if self._process is None or not self._process.is_alive():
+            self._start()
+
+        try:
+            self._conn.send(task)
+            if self._conn.poll(self.timeout):
+                return self._conn.recv()
+            status, result = 'TIMEOUT', None
+        except (EOFError, OSError):
+            # процесс завершился до ответа или не успел прочитать задачу
+            status, result = 'CRASH', None
+        # зависший или упавший процесс перезапускается
+        # на следующем документе
+        self._kill()
+        return status, result
+
+    def _process_document(self, kind: str, supplier_path: str,
+                          doc_file: str) -> str:
+        """Разбор документа в процессе-обработчике."""
+        status, result = self.call(
+            DOCUMENT_HANDLERS[kind], supplier_path, doc_file
+        )
+        if status == 'OK':
+            return result
+
+        error_str = (
+            'Ошибка разбора файла {}. Поставщик {}. Причина: {}'
+        ).format(basename(doc_file), supplier_path, WORKER_ERRORS[status])
+        print(error_str)
+        if status == 'ERROR':
+            logger.error('%s\n%s', error_str, result)
+        else:
+            logger.error(error_str)
+        return ''
+
+
 def repack_diadoc_archive(supplier_path: str, full_archive_file: str) -> bool:
     """Распаковка архива во временную папку."""
     is_success: bool = False
@@ -670,20 +1395,28 @@ def repack_diadoc_archive(supplier_path: str, full_archive_file: str) -> bool:
     return is_success
 
 
+def is_diadoc_archive_name(path: str):
+    """Функция проверяет, похоже ли имя на необработанный архив Диадока."""
+    return (path.lower().endswith('.zip')
+            and not path.upper().startswith('ОБРАБОТАНО_'))
+
+
+def is_sbis_dir_name(path: str):
+    """Функция проверяет, похоже ли имя на папку СБИСа."""
+    return (path.upper().startswith('ПОСТУПЛЕНИЯ')
+            or path.upper().startswith('АКТЫ СВЕРКИ'))
+
+
 def is_diadoc_archive(full_path: str):
     """Функция проверяет, относится ли папка к Диадоку."""
-    path = basename(full_path)
     return (os.path.isfile(full_path)
-            and path.lower().endswith('.zip')
-            and not path.upper().startswith('ОБРАБОТАНО_'))
+            and is_diadoc_archive_name(basename(full_path)))
 
 
 def is_sbis_dir(full_path: str):
     """Функция проверяет, относится ли папка к СБИСу."""
-    path = basename(full_path)
     return (os.path.isdir(full_path)
-            and (path.upper().startswith('ПОСТУПЛЕНИЯ')
-            or path.upper().startswith('АКТЫ СВЕРКИ')))
+            and is_sbis_dir_name(basename(full_path)))
 
 
 def is_sbis_doc_type(full_path: str):
@@ -714,140 +1447,1009 @@ def is_sbis_doc_type(full_path: str):
     return ''
 
 
-def processing_buffer() -> None:
+class WorkItem(NamedTuple):
+    """Элемент работы в буфере: архив Диадока или папка СБИСа."""
+
+    kind: str
+    supplier: str
+    path: str
+    size: int
+    mtime: float
+
+
+def get_dir_size(full_path: str) -> int:
+    """Суммарный размер файлов в папке."""
+    size = 0
+    for entry in os.scandir(full_path):
+        if entry.is_dir(follow_symlinks=False):
+            size += get_dir_size(entry.path)
+        elif entry.is_file(follow_symlinks=False):
+            size += entry.stat().st_size
+    return size
+
+
+def scan_supplier(supplier_entry: os.DirEntry) -> list:
+    """Поиск необработанных архивов и папок СБИСа поставщика.
+
+    Элементы, которые другой узел переименовал или удалил во время
+    сканирования, пропускаются.
+    """
+    items = []
+    for entry in os.scandir(supplier_entry.path):
+        try:
+            if entry.is_file() and is_diadoc_archive_name(entry.name):
+                stat = entry.stat()
+                items.append(WorkItem(
+                    'DIADOC',
+                    supplier_entry.name,
+                    entry.path,
+                    stat.st_size,
+                    stat.st_mtime,
+                ))
+            elif entry.is_dir() and is_sbis_dir_name(entry.name):
+                items.append(WorkItem(
+                    'SBIS',
+                    supplier_entry.name,
+                    entry.path,
+                    get_dir_size(entry.path),
+                    entry.stat().st_mtime,
+                ))
+        except FileNotFoundError:
+            continue
+    return items
+
+
+def load_scan_state() -> dict:
+    """Загрузка состояния предыдущего сканирования буфера."""
+    try:
+        with open(SCAN_STATE_FILE, 'r', encoding='utf-8') as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_scan_state(state: dict) -> None:
+    """Сохранение состояния сканирования буфера."""
+    if dirname(SCAN_STATE_FILE) and not exists(dirname(SCAN_STATE_FILE)):
+        os.makedirs(dirname(SCAN_STATE_FILE))
+    tmp_file = f'{SCAN_STATE_FILE}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as state_file:
+        json.dump(state, state_file, ensure_ascii=False, indent=1)
+    os.replace(tmp_file, SCAN_STATE_FILE)
+
+
+def scan_buffer(full_scan: bool = False) -> list:
+    """Сканирование буфера и формирование списка работ.
+
+    Папка поставщика, время изменения которой не поменялось с прошлого
+    сканирования и в которой тогда не было необработанных архивов,
+    пропускается без чтения её содержимого.
+    """
+    old_state = {} if full_scan else load_scan_state()
+    state = {}
+    items = []
+    for supplier_entry in os.scandir(BUFFER_DIR):
+        if (supplier_entry.name.startswith('.')
+                or not supplier_entry.is_dir()):
+            continue
+        mtime = supplier_entry.stat().st_mtime
+        old_supplier_state = old_state.get(supplier_entry.name, {})
+        if (old_supplier_state.get('mtime') == mtime
+                and old_supplier_state.get('pending') == 0):
+            state[supplier_entry.name] = old_supplier_state
+            continue
+
+        supplier_items = scan_supplier(supplier_entry)
+        state[supplier_entry.name] = {
+            'mtime': mtime,
+            'pending': len(supplier_items),
+        }
+        items.extend(supplier_items)
+    save_scan_state(state)
+    return items
+
+
+def save_manifest(items: list, manifest_file: str) -> None:
+    """Сохранение списка работ в файл json."""
+    with open(manifest_file, 'w', encoding='utf-8') as out_file:
+        json.dump(
+            [item._asdict() for item in items],
+            out_file,
+            ensure_ascii=False,
+            indent=1,
+        )
+
+
+def get_lease_name(item_path: str) -> str:
+    """Имя папки аренды элемента буфера.
+
+    Путь относительно буфера записывается одним именем: "_" удваивается,
+    разделитель папок заменяется на "_s", поэтому разные пути не дают
+    одинаковых имён.
+    """
+    return relpath(item_path, BUFFER_DIR).replace('_', '__').replace(
+        os.sep, '_s'
+    )
+
+
+class LeaseLostError(Exception):
+    """Аренда элемента буфера перешла к другому узлу."""
+
+
+class WorkLease:
+    """Аренда элемента буфера для обработки с нескольких машин.
+
+    Для каждого элемента в LEASE_DIR заводится папка с файлами поколений
+    аренды <номер>.lease. Аренду держит тот, чей файл имеет наибольший номер.
+    Взять элемент - создать атомарно (O_EXCL) файл следующего поколения,
+    если последнее поколение просрочено, и убедиться, что новее никого нет.
+    Пока элемент в работе, поток продлевает аренду, обновляя время изменения
+    файла, и проверяет, что аренда не перешла к другому узлу. Живые файлы
+    аренды никогда не переименовываются и не удаляются чужим узлом:
+    удаляются только поколения, заменённые более новым. Когда элемент
+    обработан (переименован или удалён), владелец удаляет свой файл
+    и папку аренды.
+    """
+
+    def __init__(self, item_path: str, ttl: float = None):
+        self.ttl = LEASE_TTL if ttl is None else ttl
+        self.item_path = item_path
+        self.lease_dir = join(LEASE_DIR, get_lease_name(item_path))
+        self.lease_path = ''
+        self.lost = False
+        self._generation = None
+        # метка отличает эту аренду от поколения с тем же номером,
+        # созданного после удаления папки аренды
+        self._owner = {
+            'host': HOST_ID,
+            'pid': os.getpid(),
+            'token': os.urandom(8).hex(),
+        }
+        self._stop_event = threading.Event()
+        self._heartbeat = None
+
+    def _get_path(self, generation: int) -> str:
+        """Путь к файлу поколения аренды."""
+        return join(self.lease_dir, f'{generation}.lease')
+
+    def _get_generations(self) -> list:
+        """Номера поколений аренды по возрастанию."""
+        generations = []
+        for entry in os.scandir(self.lease_dir):
+            name, ext = os.path.splitext(entry.name)
+            if ext == '.lease' and name.isdigit():
+                generations.append(int(name))
+        return sorted(generations)
+
+    def _is_stale(self, generation: int) -> bool:
+        """Аренда не продлевалась дольше ttl секунд или освобождена."""
+        try:
+            mtime = os.stat(self._get_path(generation)).st_mtime
+        except FileNotFoundError:
+            # поколение удалено владельцем более нового или владельцем,
+            # обработавшим элемент; в обоих случаях перехватывать нечего
+            return False
+        return time.time() - mtime >= self.ttl
+
+    def _read_owner(self, generation: int) -> dict:
+        """Чтение владельца поколения аренды."""
+        try:
+            with open(self._get_path(generation), 'r',
+                      encoding='utf-8') as lease_file:
+                return json.load(lease_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _is_held(self) -> bool:
+        """Аренда всё ещё принадлежит этому процессу."""
+        try:
+            generations = self._get_generations()
+        except OSError:
+            return False
+        return (bool(generations)
+                and generations[-1] == self._generation
+                and self._read_owner(self._generation) == self._owner)
+
+    def acquire(self) -> bool:
+        """Попытка взять элемент в работу."""
+        try:
+            os.makedirs(self.lease_dir, exist_ok=True)
+            generations = self._get_generations()
+            if generations and not self._is_stale(generations[-1]):
+                return False
+
+            generation = generations[-1] + 1 if generations else 0
+            lease_fd = os.open(
+                self._get_path(generation),
+                os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+            )
+        except (FileExistsError, FileNotFoundError):
+            # аренду взял другой узел или удалил папку, обработав элемент
+            return False
+        with os.fdopen(lease_fd, 'w', encoding='utf-8') as lease_file:
+            json.dump(self._owner, lease_file)
+
+        self._generation = generation
+        if not self._is_held():
+            # список поколений устарел, аренду уже взял другой узел
+            with contextlib.suppress(OSError):
+                os.remove(self._get_path(generation))
+            self._generation = None
+            return False
+
+        self.lease_path = self._get_path(generation)
+        for old_generation in generations:
+            if old_generation == generations[-1]:
+                owner = self._read_owner(old_generation)
+                if owner:
+                    logger.warning(
+                        'Снята просроченная аренда %s (%s)',
+                        self.lease_dir,
+                        owner,
+                    )
+            with contextlib.suppress(OSError):
+                os.remove(self._get_path(old_generation))
+
+        self._heartbeat = threading.Thread(target=self._renew, daemon=True)
+        self._heartbeat.start()
+        return True
+
+    def _renew(self) -> None:
+        """Продление аренды, пока элемент в работе."""
+        while not self._stop_event.wait(self.ttl / 3):
+            if not self._is_held():
+                self.lost = True
+                logger.error(
+                    'Аренда %s перешла к другому узлу', self.lease_dir
+                )
+                return
+            try:
+                os.utime(self.lease_path)
+            except OSError:
+                self.lost = True
+                logger.error('Аренда %s потеряна', self.lease_dir)
+                return
+
+    def check(self) -> None:
+        """Проверка аренды перед очередным шагом обработки элемента."""
+        if self.lost or not self._is_held():
+            self.lost = True
+            raise LeaseLostError(self.lease_dir)
+
+    def release(self) -> None:
+        """Освобождение элемента."""
+        self._stop_event.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        if self._generation is None or not self._is_held():
+            return
+        if exists(self.item_path):
+            # освобождённая аренда остаётся последним поколением, но сразу
+            # считается просроченной
+            os.utime(self.lease_path, (0, 0))
+            return
+        # элемент обработан, аренда больше не нужна; папку не удастся
+        # удалить, если в ней уже создал поколение другой узел
+        with contextlib.suppress(OSError):
+            os.remove(self.lease_path)
+            os.rmdir(self.lease_dir)
+
+
+def get_priority(name: str, priority_list: list) -> int:
+    """Класс приоритета по позиции в списке, не указанные - последними."""
+    if name.upper() in priority_list:
+        return priority_list.index(name.upper())
+    return len(priority_list)
+
+
+def schedule_work_items(items: list) -> list:
+    """Упорядочивание списка работ.
+
+    Сначала поставщики и виды работ из PRIORITY_SUPPLIERS и PRIORITY_KINDS
+    в порядке перечисления, внутри класса приоритета - самые крупные,
+    чтобы долгие работы начинались раньше.
+    """
+    return sorted(
+        items,
+        key=lambda item: (
+            get_priority(item.supplier, PRIORITY_SUPPLIERS),
+            get_priority(item.kind, PRIORITY_KINDS),
+            -item.size,
+        ),
+    )
+
+
+def estimate_duration(items: list, jobs: int,
+                      bytes_per_second: float) -> float:
+    """Оценка длительности обработки списка работ в jobs потоков."""
+    loads = [0.0] * jobs
+    for item in items:
+        # очередная работа достаётся первому освободившемуся потоку
+        heapq.heapreplace(loads, loads[0] + item.size / bytes_per_second)
+    return max(loads)
+
+
+def load_run_stats() -> dict:
+    """Загрузка статистики предыдущего запуска."""
+    try:
+        with open(RUN_STATS_FILE, 'r', encoding='utf-8') as stats_file:
+            return json.load(stats_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_run_stats(stats: dict) -> None:
+    """Сохранение статистики запуска."""
+    with open(RUN_STATS_FILE, 'w', encoding='utf-8') as stats_file:
+        json.dump(stats, stats_file, indent=1)
+
+
+def processing_buffer(profiler: BufferProfiler = None,
+                      full_scan: bool = False, jobs: int = 1) -> None:
     """Обработка папки-буфера с выгруженными из Диадока и СБИСа архивами."""
     logger.info('------------Старт обработки------------')
-    # проход по папкам поставщиков
-    for supplier_path in os.listdir(BUFFER_DIR):
-        full_supplier_path = join(BUFFER_DIR, supplier_path)
-        if os.path.isdir(
-                full_supplier_path
-        ):  # проверка, что это именно папка, а не файл
-
-            # проход по файлам внутри папок поставщиков
-            for archive_file in os.listdir(full_supplier_path):
-                full_archive_file = join(full_supplier_path, archive_file)
-                if is_diadoc_archive(full_archive_file):  # Это Диадок
-                    is_success = True
-                    # если в папке есть не обработанные архивы,
-                    # тогда и показываем, что делаем обработку папки
-                    logger.info('Обработка папки %s', supplier_path)
-                    print(f'----------{supplier_path}----------')
-
-                    logger.info('Распаковка файла %s', archive_file)
-                    print(f'Распаковка файла {archive_file}')
-
-                    # распаковка архива во временную папку
-                    with tempfile.TemporaryDirectory() as tmpdirname:
-                        _tmp_archive_file = join(tmpdirname, archive_file)
-
-                        # копирование архива во временную папку
-                        copyfile(full_archive_file, _tmp_archive_file)
-                        unpack_zip(_tmp_archive_file)  # распаковка
-                        os.remove(_tmp_archive_file)  # удаление архива
-                        for doc_dir in os.listdir(
-                                tmpdirname
-                        ):  # перебор папок с документами
-                            full_doc_dir = join(tmpdirname, doc_dir)
-                            for doc_file in os.listdir(full_doc_dir):
-                                full_doc_file = join(full_doc_dir, doc_file)
-                                if os.path.isfile(full_doc_file):
-                                    # документ xml
-                                    if doc_file.upper().startswith(
-                                            'ON_NSCHFDOPPR'
-                                    ) and doc_file.upper().endswith('.XML'):
-                                        _dest_path = process_xml(
-                                            supplier_path, full_doc_file
-                                        )
-                                        _result = _dest_path != ''
-                                        if _result:
-                                            pack_and_move_diadoc(
-                                                dirname(full_doc_file),
-                                                _dest_path,
-                                            )
-                                        is_success = is_success and _result
-                                    elif (doc_file.upper().endswith('.PDF')
-                                            and
-                                            'ФАКТУРА' not in doc_file.upper()
-                                            and
-                                            'ПЕЧАТНАЯ ФОРМА' in doc_file.upper()
-                                            and
-                                            'ON_NSCHFDOPPR' not in doc_dir.upper()
-                                          ):
-                                        _dest_path = process_pdf(
-                                            supplier_path, full_doc_file
-                                        )
-                                        _result = _dest_path != ''
-                                        if _result:
-                                            pack_and_move_diadoc(
-                                                dirname(full_doc_file),
-                                                _dest_path,
-                                            )
-                                        is_success = is_success and _result
-
-                    if is_success:
-                        os.rename(
-                            full_archive_file,
-                            join(full_supplier_path,
-                                 'Обработано_' + archive_file
-                                 ),
+    items = schedule_work_items(scan_buffer(full_scan))
+    logger.info('Найдено необработанных архивов и папок: %s', len(items))
+    if profiler is None:
+        processing_scheduled(items, jobs)
+        return
+
+    # при профилировании документы разбираются в текущем процессе,
+    # иначе разбор не попадёт в профиль
+    worker = DocumentWorker(0, profiler)
+    try:
+        if profiler.per_supplier:
+            processing_by_supplier(items, worker, profiler)
+        else:
+            with profiler.profile('combined'):
+                for item in items:
+                    process_work_item(item, worker)
+    finally:
+        worker.stop()
+        profiler.save_documents()
+
+
+def processing_by_supplier(
+        items: list,
+        worker: DocumentWorker,
+        profiler: BufferProfiler,
+) -> None:
+    """Обработка списка работ с профилем по каждому поставщику."""
+    for supplier_path, supplier_items in itertools.groupby(
+            sorted(items, key=lambda item: item.supplier),
+            key=lambda item: item.supplier,
+    ):
+        with profiler.profile(supplier_path):
+            for item in supplier_items:
+                process_work_item(item, worker)
+
+
+def processing_scheduled(items: list, jobs: int) -> None:
+    """Обработка списка работ по порядку в jobs потоков.
+
+    У каждого потока свой процесс-обработчик документов. Перед началом
+    по скорости предыдущего запуска оценивается время окончания,
+    по завершении оно сравнивается с фактическим.
+    """
+    start_time = datetime.datetime.now()
+    bytes_per_second = load_run_stats().get('bytes_per_second')
+    expected_time = None
+    if items and bytes_per_second:
+        expected_time = start_time + datetime.timedelta(
+            seconds=estimate_duration(items, jobs, bytes_per_second)
+        )
+        logger.info('Ожидаемое окончание обработки: %s', expected_time)
+        print(f'Ожидаемое окончание обработки: {expected_time:%H:%M:%S}')
+
+    thread_data = threading.local()
+    workers = []
+    durations = []
+
+    def run_item(item: WorkItem) -> None:
+        worker = getattr(thread_data, 'worker', None)
+        if worker is None:
+            worker = thread_data.worker = DocumentWorker(DOC_TIMEOUT)
+            workers.append(worker)
+        item_start_time = time.perf_counter()
+        if process_work_item(item, worker):
+            durations.append(
+                (item.size, time.perf_counter() - item_start_time)
+            )
+
+    executor = concurrent.futures.ThreadPoolExecutor(jobs)
+    futures = []
+    try:
+        futures.extend(executor.submit(run_item, item) for item in items)
+        for future in futures:
+            future.result()
+    finally:
+        # ещё не начатые работы отменяются, начатые дорабатываются
+        for future in futures:
+            future.cancel()
+        executor.shutdown()
+        for worker in workers:
+            worker.stop()
+
+    finish_time = datetime.datetime.now()
+    logger.info(
+        'Окончание обработки: %s (ожидалось %s)', finish_time, expected_time
+    )
+    if expected_time is not None:
+        print(
+            f'Окончание обработки: {finish_time:%H:%M:%S}, '
+            f'ожидалось {expected_time:%H:%M:%S}'
+        )
+
+    total_size = sum(size for size, _ in durations)
+    total_duration = sum(duration for _, duration in durations)
+    if total_size and total_duration:
+        save_run_stats({'bytes_per_second': total_size / total_duration})
+
+
+def process_work_item(item: WorkItem, worker: DocumentWorker) -> bool:
+    """Обработка архива или папки СБИСа.
+
+    Возвращает False, если элемент взят в работу другим узлом.
+    """
+    lease = WorkLease(item.path)
+    if not lease.acquire():
+        logger.info('%s обрабатывается на другом узле', item.path)
+        return False
+    try:
+        # пока элемент ждал в списке, его мог обработать другой узел
+        if not exists(item.path):
+            return False
+        if item.kind == 'DIADOC':
+            process_diadoc_archive(item.supplier, item.path, worker, lease)
+        elif item.kind == 'SBIS':
+            process_sbis_dir(item.supplier, item.path, worker, lease)
+        return True
+    except LeaseLostError:
+        # элемент дообработает узел, перехвативший аренду
+        error_str = 'Обработка {} прервана: аренда перешла к другому узлу'
+        print(error_str.format(item.path))
+        logger.error(error_str.format(item.path))
+        return False
+    finally:
+        lease.release()
+
+
+def process_diadoc_archive(supplier_path: str, full_archive_file: str,
+                           worker: DocumentWorker,
+                           lease: WorkLease = None) -> bool:
+    """Обработка архива Диадока.
+
+    Перед каждым документом и перед пометкой архива обработанным
+    проверяется аренда lease (LeaseLostError, если она потеряна).
+    """
+    full_supplier_path = dirname(full_archive_file)
+    archive_file = basename(full_archive_file)
+    is_success = True
+    # если в папке есть не обработанные архивы,
+    # тогда и показываем, что делаем обработку папки
+    logger.info('Обработка папки %s', supplier_path)
+    print(f'----------{supplier_path}----------')
+
+    logger.info('Распаковка файла %s', archive_file)
+    print(f'Распаковка файла {archive_file}')
+
+    # распаковка архива во временную папку
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        _tmp_archive_file = join(tmpdirname, archive_file)
+
+        # копирование архива во временную папку
+        copyfile(full_archive_file, _tmp_archive_file)
+        unpack_zip(_tmp_archive_file)  # распаковка
+        os.remove(_tmp_archive_file)  # удаление архива
+        for doc_dir in os.listdir(
+                tmpdirname
+        ):  # перебор папок с документами
+            full_doc_dir = join(tmpdirname, doc_dir)
+            for doc_file in os.listdir(full_doc_dir):
+                full_doc_file = join(full_doc_dir, doc_file)
+                if os.path.isfile(full_doc_file):
+                    if lease is not None:
+                        lease.check()
+                    # документ xml
+                    if doc_file.upper().startswith(
+                            'ON_NSCHFDOPPR'
+                    ) and doc_file.upper().endswith('.XML'):
+                        _dest_path = worker.process(
+                            'XML', supplier_path,
+                            full_doc_file
                         )
-                elif is_sbis_dir(full_archive_file):  # Это СБИС:
-                    is_success = True
-                    # если в папке есть не обработанные архивы,
-                    # тогда и показываем, что делаем обработку папки
-                    logger.info('Обработка папки %s', supplier_path)
-                    print(f'----------{supplier_path}----------')
-
-                    for doc_file in os.listdir(full_archive_file):
-                        full_doc_file = join(full_archive_file, doc_file)
-                        if os.path.isfile(full_doc_file):
-                            sbis_doc_type = is_sbis_doc_type(full_doc_file)
-
-                            if sbis_doc_type == 'XML':
-                                _dest_path = process_xml(
-                                    supplier_path,
-                                    full_doc_file
-                                )
-                                _result = _dest_path != ''
-                                if _result:
-                                    pack_and_move_sbis(
-                                        full_doc_file,
-                                        _dest_path
-                                    )
-                                is_success = is_success and _result
-                            elif sbis_doc_type == 'PDF':
-                                _dest_path = process_pdf(
-                                    supplier_path,
-                                    full_doc_file
-                                )
-                                _result = _dest_path != ''
-                                if _result:
-                                    pack_and_move_sbis(
-                                        full_doc_file,
-                                        _dest_path
-                                    )
-                                is_success = is_success and _result
-                            else:
-                                _dest_path = ''
-
-                    if is_success:
-                        with open(
-                                join(
-                                    full_supplier_path,
-                                    f'Обработано {archive_file}.txt'
-                                ),
-                                'w+',
-                        ) as my_file:
-                            my_file.write('')
-                            my_file.close()
-                        rmtree(full_archive_file)
+                        _result = _dest_path != ''
+                        if _result:
+                            _result = pack_and_move_diadoc(
+                                dirname(full_doc_file),
+                                _dest_path,
+                                full_archive_file,
+                            )
+                        is_success = is_success and _result
+                    elif (doc_file.upper().endswith('.PDF')
+                            and
+                            'ФАКТУРА' not in doc_file.upper()
+                            and
+                            'ПЕЧАТНАЯ ФОРМА' in doc_file.upper()
+                            and
+                            'ON_NSCHFDOPPR' not in doc_dir.upper()
+                          ):
+                        _dest_path = worker.process(
+                            'PDF', supplier_path,
+                            full_doc_file
+                        )
+                        _result = _dest_path != ''
+                        if _result:
+                            _result = pack_and_move_diadoc(
+                                dirname(full_doc_file),
+                                _dest_path,
+                                full_archive_file,
+                            )
+                        is_success = is_success and _result
+
+    if is_success:
+        if lease is not None:
+            lease.check()
+        os.rename(
+            full_archive_file,
+            join(full_supplier_path,
+                 'Обработано_' + archive_file
+                 ),
+        )
+    return is_success
+
+
+def process_sbis_dir(supplier_path: str, full_archive_file: str,
+                     worker: DocumentWorker,
+                     lease: WorkLease = None) -> bool:
+    """Обработка папки СБИСа.
+
+    Аренда lease проверяется так же, как в process_diadoc_archive.
+    """
+    full_supplier_path = dirname(full_archive_file)
+    archive_file = basename(full_archive_file)
+    is_success = True
+    # если в папке есть не обработанные архивы,
+    # тогда и показываем, что делаем обработку папки
+    logger.info('Обработка папки %s', supplier_path)
+    print(f'----------{supplier_path}----------')
+
+    # сжатые файлы папки, общие для архивов нескольких документов
+    member_cache = {}
+    for doc_entry in os.scandir(full_archive_file):
+        full_doc_file = doc_entry.path
+        if doc_entry.is_file():
+            if lease is not None:
+                lease.check()
+            sbis_doc_type = is_sbis_doc_type(full_doc_file)
+
+            if sbis_doc_type == 'XML':
+                _dest_path = worker.process(
+                    'XML',
+                    supplier_path,
+                    full_doc_file
+                )
+                _result = _dest_path != ''
+                if _result:
+                    _result = pack_and_move_sbis(
+                        full_doc_file,
+                        _dest_path,
+                        full_archive_file,
+                        member_cache,
+                    )
+                is_success = is_success and _result
+            elif sbis_doc_type == 'PDF':
+                _dest_path = worker.process(
+                    'PDF',
+                    supplier_path,
+                    full_doc_file
+                )
+                _result = _dest_path != ''
+                if _result:
+                    _result = pack_and_move_sbis(
+                        full_doc_file,
+                        _dest_path,
+                        full_archive_file,
+                        member_cache,
+                    )
+                is_success = is_success and _result
+            else:
+                _dest_path = ''
+
+    if is_success:
+        if lease is not None:
+            lease.check()
+        with open(
+                join(
+                    full_supplier_path,
+                    f'Обработано {archive_file}.txt'
+                ),
+                'w+',
+        ) as my_file:
+            my_file.write('')
+            my_file.close()
+        rmtree(full_archive_file)
+    return is_success
 
 
 # загружаем основной путь к папке с архивами
 MAIN_DOC_DIR = os.path.normpath(os.environ.get('MAIN_DOC_DIR'))
 BUFFER_DIR = join(MAIN_DOC_DIR, 'Буфер')
+# ограничение времени на разбор одного документа, секунд (0 - без ограничения)
+DOC_TIMEOUT = float(os.environ.get('DOC_TIMEOUT', 120))
+# предел кэша сжатых общих файлов папки СБИСа, байт
+MEMBER_CACHE_SIZE = int(os.environ.get('MEMBER_CACHE_SIZE', 64 * 2 ** 20))
+# индекс архива документов; SQLite ненадёжно блокирует файлы на сетевых
+# дисках, поэтому по умолчанию индекс локальный, у каждой машины свой
+# (общий индекс по архиву собирает "index rebuild")
+# (относительный путь отсчитывается от папки скрипта, как и .env)
+INDEX_DB = join(
+    dirname(os.path.abspath(__file__)),
+    os.environ.get('INDEX_DB', 'index.sqlite3'),
+)
+# состояние предыдущего сканирования буфера
+SCAN_STATE_FILE = os.environ.get('SCAN_STATE_FILE', 'scan_state.json')
+# аренды элементов буфера для обработки с нескольких машин
+LEASE_DIR = join(BUFFER_DIR, '.leases')
+LEASE_TTL = float(os.environ.get('LEASE_TTL', 300))
+HOST_ID = os.environ.get('HOST_ID', socket.gethostname())
+# приоритетные поставщики и виды работ (DIADOC, SBIS) через ";"
+PRIORITY_SUPPLIERS = [
+    name.strip().upper()
+    for name in os.environ.get('PRIORITY_SUPPLIERS', '').split(';')
+    if name.strip()
+]
+PRIORITY_KINDS = [
+    name.strip().upper()
+    for name in os.environ.get('PRIORITY_KINDS', '').split(';')
+    if name.strip()
+]
+# скорость обработки предыдущего запуска для оценки времени окончания
+RUN_STATS_FILE = os.environ.get('RUN_STATS_FILE', 'run_stats.json')
 
 logger = get_logger()
-processing_buffer()
-print('Загрузка завершена.')
+
+
+# Поля результата проверки правил разбора на корпусе документов
+CLASSIFY_FIELDS = (
+    'file',
+    'kind',
+    'doc_type',
+    'market_type',
+    'doc_number',
+    'doc_date',
+    'rule',
+    'duration',
+    'error',
+)
+# Поля, изменение которых считается расхождением с эталоном
+CLASSIFY_COMPARED_FIELDS = (
+    'kind',
+    'doc_type',
+    'market_type',
+    'doc_number',
+    'doc_date',
+    'error',
+)
+
+
+def get_corpus_doc_kind(doc_file: str) -> str:
+    """Тип документа (xml/pdf) по правилам отбора Диадока и СБИСа."""
+    sbis_doc_type = is_sbis_doc_type(doc_file)
+    if sbis_doc_type:
+        return sbis_doc_type
+
+    doc_name = basename(doc_file).upper()
+    if doc_name.startswith('ON_NSCHFDOPPR') and doc_name.endswith('.XML'):
+        return 'XML'
+    if (doc_name.endswith('.PDF')
+            and 'ФАКТУРА' not in doc_name
+            and 'ПЕЧАТНАЯ ФОРМА' in doc_name
+            and 'ON_NSCHFDOPPR' not in basename(dirname(doc_file)).upper()):
+        return 'PDF'
+    return ''
+
+
+def new_classify_row(corpus_dir: str, doc_file: str, kind: str) -> dict:
+    """Пустая строка результата разбора документа корпуса."""
+    row = dict.fromkeys(CLASSIFY_FIELDS, '')
+    row['file'] = relpath(doc_file, corpus_dir).replace('\\', '/')
+    row['kind'] = kind
+    return row
+
+
+def classify_document(corpus_dir: str, doc_file: str, kind: str) -> dict:
+    """Разбор документа корпуса без упаковки и перемещения."""
+    start_time = time.perf_counter()
+    row = new_classify_row(corpus_dir, doc_file, kind)
+    try:
+        row.update(DOCUMENT_CLASSIFIERS[kind](doc_file))
+        if isinstance(row['doc_date'], datetime.date):
+            row['doc_date'] = row['doc_date'].strftime(r'%d.%m.%Y')
+    except Exception as exc:  # pylint: disable=broad-except
+        row['error'] = f'{type(exc).__name__}: {exc}'
+    row['duration'] = round(time.perf_counter() - start_time, 3)
+    return row
+
+
+def classify_corpus(corpus_dir: str, jobs: int) -> list:
+    """Параллельный разбор всех документов корпуса.
+
+    Документы разбираются в jobs процессах-обработчиках с ограничением
+    DOC_TIMEOUT на документ, как при обработке буфера. Зависший или
+    упавший разбор даёт строку с причиной в поле error.
+    """
+    doc_files = []
+    kinds = []
+    for folder, _, files in os.walk(corpus_dir):
+        for file in files:
+            kind = get_corpus_doc_kind(join(folder, file))
+            if kind:
+                doc_files.append(join(folder, file))
+                kinds.append(kind)
+
+    thread_data = threading.local()
+    workers = []
+
+    def classify(doc_file: str, kind: str) -> dict:
+        worker = getattr(thread_data, 'worker', None)
+        if worker is None:
+            worker = thread_data.worker = DocumentWorker(DOC_TIMEOUT)
+            workers.append(worker)
+        start_time = time.perf_counter()
+        status, result = worker.call(
+            classify_document, corpus_dir, doc_file, kind
+        )
+        if status == 'OK':
+            return result
+
+        row = new_classify_row(corpus_dir, doc_file, kind)
+        row['error'] = WORKER_ERRORS[status]
+        row['duration'] = round(time.perf_counter() - start_time, 3)
+        logger.error(
+            'Ошибка разбора файла %s: %s\n%s',
+            row['file'],
+            row['error'],
+            result or '',
+        )
+        return row
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            rows = list(executor.map(classify, doc_files, kinds))
+    finally:
+        for worker in workers:
+            worker.stop()
+    return sorted(rows, key=lambda row: row['file'])
+
+
+def save_classification(rows: list, out_file_name: str) -> None:
+    """Сохранение результата разбора корпуса в csv или json."""
+    if out_file_name.lower().endswith('.json'):
+        with open(out_file_name, 'w', encoding='utf-8') as out_file:
+            json.dump(rows, out_file, ensure_ascii=False, indent=1)
+        return
+
+    with open(out_file_name, 'w', encoding='utf-8-sig',
+              newline='') as out_file:
+        writer = csv.DictWriter(out_file, CLASSIFY_FIELDS, delimiter=';')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def load_classification(in_file_name: str) -> dict:
+    """Загрузка сохранённого результата разбора корпуса."""
+    if in_file_name.lower().endswith('.json'):
+        with open(in_file_name, 'r', encoding='utf-8') as in_file:
+            rows = json.load(in_file)
+    else:
+        with open(in_file_name, 'r', encoding='utf-8-sig',
+                  newline='') as in_file:
+            rows = list(csv.DictReader(in_file, delimiter=';'))
+    return {row['file']: row for row in rows}
+
+
+def is_run_dated(row: dict) -> bool:
+    """Дата документа взята не из документа, а от даты запуска.
+
+    Датой акта сверки PDF считается последний день предыдущего месяца,
+    поэтому с эталоном, сохранённым в другом месяце, она не сравнивается.
+    """
+    return row['kind'] == 'PDF' and row['doc_type'].startswith('АСВ')
+
+
+def diff_classification(rows: list, baseline: dict) -> list:
+    """Расхождения результата разбора корпуса с эталоном."""
+    diffs = []
+    files = set()
+    for row in rows:
+        files.add(row['file'])
+        old_row = baseline.get(row['file'])
+        if old_row is None:
+            diffs.append(f'+ {row["file"]}')
+            continue
+        for field in CLASSIFY_COMPARED_FIELDS:
+            if field == 'doc_date' and is_run_dated(row):
+                continue
+            if str(old_row.get(field, '')) != str(row[field]):
+                diffs.append(
+                    f'~ {row["file"]}: {field} '
+                    f'"{old_row.get(field, "")}" -> "{row[field]}"'
+                )
+    for file in sorted(set(baseline) - files):
+        diffs.append(f'- {file}')
+    return diffs
+
+
+def run_classify_command(args: argparse.Namespace) -> int:
+    """Проверка правил разбора на корпусе документов."""
+    rows = classify_corpus(args.corpus, args.jobs)
+    save_classification(rows, args.output)
+    resolved = sum(
+        1 for row in rows if not row['error'] and NOT_RESOLVED not in (
+            row['doc_type'], row['market_type'], row['doc_number'],
+            row['doc_date'],
+        )
+    )
+    print(f'Документов: {len(rows)}, разобрано: {resolved}')
+    if not args.baseline:
+        return 0
+
+    diffs = diff_classification(rows, load_classification(args.baseline))
+    for diff in diffs:
+        print(diff)
+    print(f'Расхождений с эталоном: {len(diffs)}')
+    return 1 if diffs else 0
+
+
+def positive_int(value: str) -> int:
+    """Тип параметра командной строки: целое число больше нуля."""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            f'ожидается целое число больше нуля: {value}'
+        )
+    return number
+
+
+def parse_args() -> argparse.Namespace:
+    """Разбор параметров командной строки."""
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument(
+        '--full-scan',
+        action='store_true',
+        help='просканировать все папки поставщиков, не пропуская '
+             'неизменившиеся с прошлого запуска',
+    )
+    arg_parser.add_argument(
+        '--jobs',
+        dest='run_jobs',
+        type=positive_int,
+        default=1,
+        help='количество архивов и папок, обрабатываемых параллельно',
+    )
+    arg_parser.add_argument(
+        '--profile',
+        choices=('combined', 'supplier'),
+        help='профилирование обработки: общий профиль или по поставщикам '
+             '(документы разбираются последовательно и без ограничения '
+             'по времени)',
+    )
+    arg_parser.add_argument(
+        '--profile-dir',
+        default='PROFILE',
+        help='папка для результатов профилирования',
+    )
+    arg_parser.add_argument(
+        '--profile-top',
+        type=int,
+        default=20,
+        help='количество самых медленных документов и функций в отчёте',
+    )
+
+    subparsers = arg_parser.add_subparsers(dest='command')
+    scan_parser = subparsers.add_parser(
+        'scan', help='сформировать список необработанных архивов и папок'
+    )
+    scan_parser.add_argument(
+        '--output', default='manifest.json', help='файл списка работ (json)'
+    )
+    classify_parser = subparsers.add_parser(
+        'classify',
+        help='проверка правил разбора на корпусе документов '
+             'без упаковки и перемещения',
+    )
+    classify_parser.add_argument('corpus', help='папка с документами')
+    classify_parser.add_argument(
+        '--output',
+        default='classify.csv',
+        help='файл результата (csv или json)',
+    )
+    classify_parser.add_argument(
+        '--baseline', help='эталонный результат для сравнения (csv или json)'
+    )
+    classify_parser.add_argument(
+        '--jobs',
+        type=positive_int,
+        default=os.cpu_count(),
+        help='количество параллельных процессов',
+    )
+    index_parser = subparsers.add_parser(
+        'index', help='индекс архива документов'
+    )
+    index_subparsers = index_parser.add_subparsers(
+        dest='index_command', required=True
+    )
+    index_subparsers.add_parser(
+        'rebuild', help='проиндексировать пакеты, уже лежащие в архиве'
+    )
+    query_parser = index_subparsers.add_parser(
+        'query', help='поиск пакетов в индексе'
+    )
+    query_parser.add_argument('--supplier', help='поставщик')
+    query_parser.add_argument('--market', help='рынок')
+    query_parser.add_argument('--type', dest='doc_type', help='тип документа')
+    query_parser.add_argument('--number', help='номер документа')
+    query_parser.add_argument(
+        '--date-from', help='дата документа с (ГГГГ-ММ-ДД)'
+    )
+    query_parser.add_argument(
+        '--date-to', help='дата документа по (ГГГГ-ММ-ДД)'
+    )
+    parsed_args = arg_parser.parse_args()
+    if parsed_args.profile and parsed_args.run_jobs != 1:
+        arg_parser.error(
+            'профилирование выполняется последовательно, --jobs с --profile '
+            'не указывается'
+        )
+    return parsed_args
+
+
+def run_index_command(args: argparse.Namespace) -> None:
+    """Выполнение команд индекса архива документов."""
+    if args.index_command == 'rebuild':
+        print(f'Проиндексировано пакетов: {rebuild_index()}')
+        return
+    if not exists(INDEX_DB):
+        print(f'Индекс {INDEX_DB} не найден, выполните "index rebuild"')
+        return
+
+    rows = query_index(
+        supplier=args.supplier,
+        market=args.market,
+        doc_type=args.doc_type,
+        number=args.number,
+        date_from=args.date_from,
+        date_to=args.date_to,
+    )
+    for row in rows:
+        print('\t'.join(
+            str(row[column]) for column in (
+                'date', 'supplier', 'market', 'doc_type', 'number', 'size',
+                'path',
+            )
+        ))
+    print(f'Найдено пакетов: {len(rows)}')
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.command == 'index':
+        run_index_command(args)
+    elif args.command == 'classify':
+        sys.exit(run_classify_command(args))
+    elif args.command == 'scan':
+        work_items = scan_buffer(args.full_scan)
+        save_manifest(work_items, args.output)
+        print(f'Найдено необработанных архивов и папок: {len(work_items)}')
+    else:
+        buffer_profiler = None
+        if args.profile:
+            buffer_profiler = BufferProfiler(
+                args.profile, args.profile_dir, args.profile_top
+            )
+        processing_buffer(buffer_profiler, args.full_scan, args.run_jobs)
+        print('Загрузка завершена.')
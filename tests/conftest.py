@@ -0,0 +1,26 @@
+"""Общие фикстуры тестов repack_orem."""
+import importlib
+import os
+import sys
+from os.path import dirname, join
+
+import pytest
+
+REPO_DIR = dirname(dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='session')
+def buffer_dir(tmp_path_factory):
+    """Буфер во временной папке и импорт скрипта с настройками на него."""
+    for module_name in ('dateutil', 'dotenv', 'tika', 'xlrd'):
+        pytest.importorskip(module_name)
+    main_dir = tmp_path_factory.mktemp('main')
+    os.makedirs(join(main_dir, 'Буфер'))
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setenv('MAIN_DOC_DIR', str(main_dir))
+        monkeypatch.chdir(main_dir)
+        monkeypatch.syspath_prepend(REPO_DIR)
+        sys.modules.pop('repack_orem', None)
+        module = importlib.import_module('repack_orem')
+        yield module, str(main_dir)
+    sys.modules.pop('repack_orem', None)
@@ -0,0 +1,165 @@
+"""Проверка аренды элементов буфера несколькими процессами-узлами."""
+import json
+import os
+import subprocess
+import sys
+import time
+from os.path import dirname, join
+
+import pytest
+
+REPO_DIR = dirname(dirname(os.path.abspath(__file__)))
+
+# процесс-узел: после импорта сообщает о готовности, по сигналу в течение
+# duration секунд берёт в работу элементы буфера и записывает интервалы,
+# в которые держал аренду
+NODE_SCRIPT = '''
+import json, sys, time
+import repack_orem
+
+items, ttl, hold, duration, out_file, release = json.loads(sys.argv[1])
+print('ready', flush=True)
+sys.stdin.readline()
+start = time.time()
+with open(out_file, 'w', encoding='utf-8') as out:
+    while time.time() < start + duration:
+        for item in items:
+            lease = repack_orem.WorkLease(item, ttl)
+            if not lease.acquire():
+                continue
+            began = time.time()
+            time.sleep(hold)
+            lease.check()
+            out.write(json.dumps([item, repack_orem.HOST_ID, began,
+                                  time.time()]) + '\\n')
+            if not release:
+                sys.exit(0)
+            lease.release()
+'''
+
+
+def run_nodes(main_dir: str, count: int, items: list, ttl: float,
+              hold: float, duration: float, release: bool = True) -> list:
+    """Запуск count узлов с разными HOST_ID, возвращает их записи."""
+    nodes = []
+    for number in range(count):
+        out_file = join(main_dir, f'node{number}.jsonl')
+        env = dict(
+            os.environ,
+            MAIN_DOC_DIR=main_dir,
+            HOST_ID=f'node{number}',
+            PYTHONPATH=os.pathsep.join(
+                [REPO_DIR] + sys.path
+            ),
+        )
+        args = json.dumps(
+            [items, ttl, hold, duration, out_file, release]
+        )
+        nodes.append((out_file, subprocess.Popen(
+            [sys.executable, '-c', NODE_SCRIPT, args],
+            cwd=main_dir,
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        )))
+    # узлы стартуют одновременно, когда все импортировали скрипт
+    for _, node in nodes:
+        assert node.stdout.readline() == 'ready\n'
+    for _, node in nodes:
+        node.stdin.write('\n')
+        node.stdin.close()
+    records = []
+    for out_file, node in nodes:
+        assert node.wait(60) == 0
+        node.stdout.close()
+        with open(out_file, 'r', encoding='utf-8') as out:
+            records.extend(json.loads(line) for line in out)
+    return records
+
+
+def test_nodes_never_hold_item_together(buffer_dir):
+    """Узлы делят элементы буфера без одновременной обработки."""
+    repack_orem, main_dir = buffer_dir
+    items = [join(repack_orem.BUFFER_DIR, f'Поставщик{number}', 'a.zip')
+             for number in range(3)]
+    records = run_nodes(main_dir, 4, items, ttl=5, hold=0.02, duration=3)
+
+    assert len({host for _, host, _, _ in records}) > 1
+    for item in items:
+        intervals = sorted(
+            (began, ended) for path, _, began, ended in records
+            if path == item
+        )
+        assert intervals
+        for (_, ended), (began, _) in zip(intervals, intervals[1:]):
+            assert ended <= began
+
+
+def test_single_node_takes_over_stale_lease(buffer_dir):
+    """Просроченную аренду перехватывает ровно один узел."""
+    repack_orem, main_dir = buffer_dir
+    item = join(repack_orem.BUFFER_DIR, 'Поставщик', 'stale.zip')
+    stale_lease = repack_orem.WorkLease(item)
+    os.makedirs(stale_lease.lease_dir)
+    stale_path = join(stale_lease.lease_dir, '0.lease')
+    with open(stale_path, 'w', encoding='utf-8') as lease_file:
+        json.dump({'host': 'dead', 'pid': 0}, lease_file)
+    os.utime(stale_path, (0, 0))
+
+    records = run_nodes(main_dir, 6, [item], ttl=60, hold=0.5, duration=1,
+                        release=False)
+
+    assert len(records) == 1
+
+
+def test_lost_lease_aborts_item(buffer_dir):
+    """Узел, не продливший аренду вовремя, не может продолжить обработку."""
+    repack_orem, _ = buffer_dir
+    item = join(repack_orem.BUFFER_DIR, 'Поставщик', 'hung.zip')
+    first = repack_orem.WorkLease(item, ttl=0.3)
+    assert first.acquire()
+    # зависший узел перестаёт продлевать аренду
+    first._stop_event.set()  # pylint: disable=protected-access
+    first._heartbeat.join()  # pylint: disable=protected-access
+    time.sleep(0.5)
+
+    second = repack_orem.WorkLease(item, ttl=0.3)
+    assert second.acquire()
+    with pytest.raises(repack_orem.LeaseLostError):
+        first.check()
+    first.release()
+    second.check()
+    second.release()
+
+
+def test_lease_names_do_not_collide(buffer_dir):
+    """Разные пути элементов дают разные папки аренды."""
+    repack_orem, _ = buffer_dir
+    names = {
+        repack_orem.get_lease_name(join(repack_orem.BUFFER_DIR, *parts))
+        for parts in (('A__B', 'x'), ('A', 'B__x'), ('A_', '_B', 'x'),
+                      ('A_s', 'x'), ('A', 's_x'))
+    }
+    assert len(names) == 5
+
+
+def test_processed_item_leaves_no_lease(buffer_dir):
+    """После обработки элемента его папка аренды удаляется."""
+    repack_orem, _ = buffer_dir
+    item = join(repack_orem.BUFFER_DIR, 'Поставщик', 'done.zip')
+    os.makedirs(dirname(item), exist_ok=True)
+    with open(item, 'wb'):
+        pass
+
+    lease = repack_orem.WorkLease(item)
+    assert lease.acquire()
+    lease.release()
+    # элемент не обработан: аренда освобождена, но остаётся
+    assert os.listdir(lease.lease_dir) == ['0.lease']
+
+    lease = repack_orem.WorkLease(item)
+    assert lease.acquire()
+    os.rename(item, join(dirname(item), 'Обработано_done.zip'))
+    lease.release()
+    assert not os.path.exists(lease.lease_dir)
@@ -0,0 +1,72 @@
+"""Проверка записи общих файлов папки СБИСа в архивы документов."""
+import os
+import zipfile
+from os.path import join
+
+
+def make_file(path: str, content: bytes) -> str:
+    """Создание файла с заданным содержимым."""
+    with open(path, 'wb') as out:
+        out.write(content)
+    return path
+
+
+def test_shared_members_written_to_several_archives(buffer_dir, tmp_path):
+    """Общие файлы сжимаются один раз и читаются из каждого архива."""
+    repack_orem, _ = buffer_dir
+    files = {
+        'СПРАВКА О ПРОХОЖДЕНИИ.pdf': os.urandom(50000) + b'a' * 100000,
+        'DP_PDPOL_1.xml': b'<a/>' * 1000,
+        'DP_UVPRIEM_1.xml': b'',
+    }
+    paths = {
+        name: make_file(str(tmp_path / name), content)
+        for name, content in files.items()
+    }
+    single = make_file(str(tmp_path / 'ON_NSCHFDOPPR_1.xml'), b'<b/>')
+    member_cache = {}
+
+    for number in range(2):
+        zip_path = str(tmp_path / f'{number}.zip')
+        with zipfile.ZipFile(zip_path, 'w') as zip_file:
+            zip_file.write(
+                single, 'ON_NSCHFDOPPR_1.xml',
+                compress_type=zipfile.ZIP_DEFLATED,
+            )
+            for name, path in paths.items():
+                repack_orem.write_shared_member(
+                    zip_file, path, join('sub', name), member_cache
+                )
+
+        with zipfile.ZipFile(zip_path) as zip_file:
+            assert zip_file.testzip() is None
+            assert zip_file.namelist() == ['ON_NSCHFDOPPR_1.xml'] + [
+                f'sub/{name}' for name in files
+            ]
+            for name, content in files.items():
+                assert zip_file.read(f'sub/{name}') == content
+    assert sorted(member_cache) == sorted(paths.values())
+
+
+def test_member_cache_limit(buffer_dir, tmp_path, monkeypatch):
+    """Файл, не помещающийся в кэш, записывается без кэширования."""
+    repack_orem, _ = buffer_dir
+    monkeypatch.setattr(repack_orem, 'MEMBER_CACHE_SIZE', 1000)
+    small = make_file(str(tmp_path / 'DP_PDPOL_1.xml'), b'<a/>' * 100)
+    large_content = os.urandom(5000)
+    large = make_file(str(tmp_path / 'СПРАВКА.pdf'), large_content)
+    member_cache = {}
+
+    zip_path = str(tmp_path / 'limit.zip')
+    with zipfile.ZipFile(zip_path, 'w') as zip_file:
+        repack_orem.write_shared_member(
+            zip_file, small, 'DP_PDPOL_1.xml', member_cache
+        )
+        repack_orem.write_shared_member(
+            zip_file, large, 'СПРАВКА.pdf', member_cache
+        )
+
+    assert list(member_cache) == [small]
+    with zipfile.ZipFile(zip_path) as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.read('СПРАВКА.pdf') == large_content